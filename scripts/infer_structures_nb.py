@@ -71,6 +71,65 @@ def get_cli_arguments():
     return parser.parse_args()
 
 
+def load_counts(matrix_filename, block_size=1000):
+    """Load a dense contact matrix as a sparse matrix.
+
+    The dense matrix is read by blocks of rows and only non-NaN, non-zero,
+    off-diagonal counts are kept, so the full dense matrix is never in memory.
+
+    Parameters
+    ----------
+    matrix_filename : str
+        Name of Matrix file: dense matrix as tab-separated text (.matrix)
+        or NumPy array (.npy), or sparse SciPy matrix (.npz)
+    block_size : int (default: 1000)
+        Number of rows read at once
+
+    Returns
+    -------
+    scipy.sparse.coo_matrix
+        Contact counts
+    """
+    if matrix_filename.endswith(".npz"):
+        counts = sparse.load_npz(matrix_filename).tocoo()
+        # iced expects double counts (see below).
+        data = counts.data.astype("double")
+        keep = ~np.isnan(data) & (data != 0) & (counts.row != counts.col)
+        return sparse.coo_matrix(
+            (data[keep], (counts.row[keep], counts.col[keep])), shape=counts.shape
+        )
+    if matrix_filename.endswith(".npy"):
+        counts_maps = np.load(matrix_filename, mmap_mode="r")
+        blocks = (
+            counts_maps[start : start + block_size]
+            for start in range(0, counts_maps.shape[0], block_size)
+        )
+    else:
+        blocks = (
+            block.to_numpy()
+            for block in pd.read_csv(
+                matrix_filename, sep='\t', header=None, chunksize=block_size
+            )
+        )
+    rows, cols, data = [], [], []
+    n_rows, n_cols = 0, 0
+    for block in blocks:
+        # to solve : File "iced/_filter_.pyx", line 15, in iced._filter_._filter_csr ValueError: Buffer dtype mismatch, expected 'DOUBLE' but got 'long'
+        block = np.asarray(block, dtype="double")
+        block_rows, block_cols = np.nonzero(~np.isnan(block) & (block != 0))
+        off_diagonal = block_rows + n_rows != block_cols
+        block_rows, block_cols = block_rows[off_diagonal], block_cols[off_diagonal]
+        data.append(block[block_rows, block_cols])
+        rows.append(block_rows + n_rows)
+        cols.append(block_cols)
+        n_rows += block.shape[0]
+        n_cols = block.shape[1]
+    return sparse.coo_matrix(
+        (np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(n_rows, n_cols),
+    )
+
+
 def run_pastis_nb(matrix_filename, bed_filename, output_filename, seed=0, percentage_to_filter=0.02):
     """Build 3D structure of genome with Pastis NB algorithme.
     
@@ -96,16 +155,7 @@ def run_pastis_nb(matrix_filename, bed_filename, output_filename, seed=0, percen
     # The dense matrix generated by HiC-Pro_3.1.0/bin/utils/sparseToDense.py is always complete.
     # The 3D model is thus inferred from it.
     #counts = io.load_counts(matrix_filename, base=1)
-    counts_maps = pd.read_csv(matrix_filename, sep='\t', header=None)
-    counts_maps = counts_maps.values
-    # to solve : File "iced/_filter_.pyx", line 15, in iced._filter_._filter_csr ValueError: Buffer dtype mismatch, expected 'DOUBLE' but got 'long'
-    counts_maps = counts_maps.astype("double")
-    #counts_maps = np.load(matrix_filename)
-    counts_maps[np.isnan(counts_maps)] = 0
-    counts = sparse.coo_matrix(counts_maps)
-    counts.setdiag(0)
-    counts.eliminate_zeros()
-    counts = counts.tocoo()
+    counts = load_counts(matrix_filename)
 
     ###############################################################################
     # Normalize the data
@@ -142,8 +192,12 @@ def run_pastis_nb(matrix_filename, bed_filename, output_filename, seed=0, percen
         ini=X.flatten())
     ###############################################################################
     # Remove beads that were not infered
-    mask = (np.array(counts.sum(axis=0)).flatten() + np.array(counts.sum(axis=1)).flatten() == 0)
-    mask = mask.flatten()
+    # i.e. beads without any non-zero count in their row or column.
+    inferred = np.zeros(counts.shape[0], dtype=bool)
+    nonzero = counts.data != 0
+    inferred[counts.row[nonzero]] = True
+    inferred[counts.col[nonzero]] = True
+    mask = ~inferred
     X_ = X.copy()
     X_[mask] = np.nan
     ###############################################################################
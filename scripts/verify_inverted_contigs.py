@@ -16,9 +16,9 @@ import sys
 
 from Bio import SeqIO
 from Bio.Seq import Seq
+from Bio.SeqIO.FastaIO import SimpleFastaParser
 from biopandas.pdb import PandasPdb
 import numpy as np
-import pandas as pd
 
 
 def get_cli_arguments():
@@ -120,17 +120,64 @@ def extract_chromosome_name_length(fasta_name):
     chromosome_length_lst = []
     with open(fasta_name, "r") as fasta_file:
         print(f"Reading genome sequence in {fasta_name}")
-        for record in SeqIO.parse(fasta_file, "fasta"):
-            name = record.id
-            length = len(record.seq)
+        # Read raw (title, sequence) pairs to avoid building SeqRecord objects.
+        for title, sequence in SimpleFastaParser(fasta_file):
+            # Same as record.id from SeqIO.parse.
+            name = title.split(None, 1)[0] if title else ""
+            length = len(sequence)
             print(f"Found chromosome {name} with {length} bases")
             chromosome_name_lst.append(name)
             chromosome_length_lst.append(length)
     return chromosome_name_lst, chromosome_length_lst
 
 
+def compute_bead_distances(coordinates):
+    """Compute Euclidean distances between adjacent beads.
+
+    Parameters
+    ----------
+    coordinates : numpy.ndarray
+        Array of shape (n, 3) with beads coordinates.
+
+    Returns
+    -------
+    numpy.ndarray
+        Distances between bead n and bead n+1.
+        The last distance is Nan because there is no bead n+1 for the last bead.
+    """
+    distances = np.empty(coordinates.shape[0], dtype=coordinates.dtype)
+    delta = np.diff(coordinates, axis=0)
+    np.einsum("ij,ij->i", delta, delta, out=distances[:-1])
+    np.sqrt(distances[:-1], out=distances[:-1])
+    distances[-1] = np.nan
+    return distances
+
+
+def select_long_distances(coordinates, threshold):
+    """Select beads far away from their next bead.
+
+    Parameters
+    ----------
+    coordinates : numpy.ndarray
+        Array of shape (n, 3) with beads coordinates.
+    threshold : float
+        Beads with a distance above threshold times the median distance
+        are selected.
+
+    Returns
+    -------
+    tuple
+        Distances between bead n and bead n+1.
+        Median distance (Nan values are ignored).
+        Boolean array with selected beads.
+    """
+    distances = compute_bead_distances(coordinates)
+    median_distance = np.nanmedian(distances)
+    return distances, median_distance, distances > threshold * median_distance
+
+
 def find_inverted_contigs(
-    pdb_name_in, chromosome_lengths, HiC_resolution, threshold
+    pdb_structure, chromosome_lengths, HiC_resolution, threshold, debug=False
 ):
     """Find inverted contigs.
 
@@ -139,21 +186,22 @@ def find_inverted_contigs(
 
     Parameters
     ----------
-    pdb_name_in : str
-        PDB file containing the 3D structure of the genome.
+    pdb_structure : biopandas.pdb.PandasPdb
+        3D structure of the genome.
     chromosome_lengths : list
         List with chromosome lengths.
     HiC_resolution : int
         HiC resolution.
     threshold : float
         Threshold to detect flipped contigs.
+    debug : bool (default: False)
+        Output one TSV file per chromosome with bead distances.
 
     Returns
     -------
     inverted_contigs : dict
         Dictionnary with inverted contigs.
     """
-    pdb_structure = PandasPdb().read_pdb(pdb_name_in)
     structure_df = pdb_structure.df["ATOM"]
     print(f"Number of beads read from structure: {structure_df.shape[0]}")
 
@@ -172,34 +220,45 @@ def find_inverted_contigs(
 
     if structure_df.shape[0] != sum(beads_per_chromosome):
         sys.exit(
-            f"Cannot process structure {pdb_name_in} because it contains "
+            f"Cannot process structure because it contains "
             f"{structure_df.shape[0]} beads "
             f"instead of {sum(beads_per_chromosome)}"
         )
 
+    # Extract once the only columns used to detect inverted contigs.
+    # Single precision is enough to compare distances to the median distance
+    # and PDB coordinates only have 3 decimals anyway.
+    atom_numbers = structure_df["atom_number"].to_numpy()
+    bead_coordinates = structure_df[coord_columns].to_numpy(dtype=np.float32)
+
+    # Beads are sorted by chromosome (see assign_chromosomes.py),
+    # so the beads of each chromosome are a contiguous slice of the structure.
+    chrom_nums, chrom_starts = np.unique(
+        structure_df["residue_number"].to_numpy(), return_index=True
+    )
+    chrom_ends = np.append(chrom_starts[1:], structure_df.shape[0])
+
     inverted_contigs = {}
 
-    for chrom_num in structure_df["residue_number"].unique():
+    for chrom_num, chrom_start, chrom_end in zip(
+        chrom_nums, chrom_starts, chrom_ends
+    ):
         print(f"\nLooking for inverted contigs into chromosome {chrom_num}")
+        bead_positions = slice(chrom_start, chrom_end)
 
-        # Select beads of one chromosome
-        chromosome_df = structure_df.query(
-            f"residue_number == {chrom_num}"
-        ).reset_index(drop=True)
-
-        # Compute Euclidean distances between bead n and bead n+1
-        chromosome_df["distance"] = np.linalg.norm(
-            chromosome_df[coord_columns].to_numpy() - chromosome_df[coord_columns].shift(-1).to_numpy(),
-            axis=1
+        # Select extremities of inverted contigs
+        # i.e. beads with distance to the next bead
+        # above a given threshold times the median distance.
+        distances, median_distance, beads_selection = select_long_distances(
+            bead_coordinates[bead_positions], threshold
         )
-        # Compute median distance with possible Nan values
-        median_distance = chromosome_df["distance"].median(skipna=True)
         print(f"Median distance between beads: {median_distance:.2f}")
 
-        # Select extremities of inverted contigs
-        # i.e. beads with distance above a given threshold.
         # Output beads coordinates with distances
-        if ARGS.debug:
+        if debug:
+            chromosome_df = structure_df.iloc[bead_positions].assign(
+                distance=distances
+            )
             filename = f"chr_{chrom_num}.tsv"
             target_columns = [
                 "record_name", "atom_number", "atom_name",
@@ -209,39 +268,32 @@ def find_inverted_contigs(
             ]
             print(f"DEBUG: writing {filename} with distances.")
             chromosome_df[target_columns].to_csv(
-                filename, sep="\t", index=False, na_rep="nan"
+                filename, sep="\t", index=False, na_rep="nan", float_format="%.3f"
             )
-        
-        beads_selection = (
-            chromosome_df["distance"] > threshold * median_distance
-        )
-        inversion_limits = chromosome_df.loc[
-            beads_selection, "atom_number"
-        ].values
+
+        inversion_limits = atom_numbers[bead_positions][beads_selection]
         if len(inversion_limits) % 2 != 0:
             print("WARNING: odd number of inversion limits found")
             print(
                 "WARNING: this might lead to a wrong detection of inverted contigs"
             )
             print(inversion_limits)
-        if len(inversion_limits) != 0:
-            for limit_1, limit_2 in zip(
-                inversion_limits[0::2], inversion_limits[1::2]
-            ):
-                print(
-                    f"Chromosome {chrom_num}: found inverted contig between bead {limit_1+1} and bead {limit_2}"
+        # Pair consecutive limits. A trailing unpaired limit is ignored.
+        pairs = inversion_limits[: len(inversion_limits) // 2 * 2].reshape(-1, 2)
+        pairs[:, 0] += 1
+        inverted_contigs[chrom_num] = [tuple(pair) for pair in pairs.tolist()]
+        if inverted_contigs[chrom_num]:
+            print(
+                "\n".join(
+                    f"Chromosome {chrom_num}: found inverted contig between bead {limit_1} and bead {limit_2}"
+                    for limit_1, limit_2 in inverted_contigs[chrom_num]
                 )
-                if chrom_num in inverted_contigs:
-                    inverted_contigs[chrom_num].append((limit_1 + 1, limit_2))
-                else:
-                    inverted_contigs[chrom_num] = [(limit_1 + 1, limit_2)]
-        else:
-            inverted_contigs[chrom_num] = []
+            )
     return inverted_contigs
 
 
 def flip_inverted_contigs_in_structure(
-    inverted_contigs, pdb_name_in, pdb_name_out
+    inverted_contigs, pdb_structure, pdb_name_out
 ):
     """Flip inverted contigs in the 3D structure of the genome.
 
@@ -249,12 +301,11 @@ def flip_inverted_contigs_in_structure(
     ----------
     inverted_contigs : dict
         Dictionnary with inverted contigs
-    pdb_name_in : str
-        PDB file containing the 3D structure of the genome
+    pdb_structure : biopandas.pdb.PandasPdb
+        3D structure of the genome
     pdb_name_out : str
         Output PDB file containing the 3D structure of the genome
     """
-    pdb_structure = PandasPdb().read_pdb(pdb_name_in)
     coordinates = pdb_structure.df["ATOM"]
     if sum(map(len, inverted_contigs.values()))== 0:
         pdb_structure.to_pdb(
@@ -263,33 +314,49 @@ def flip_inverted_contigs_in_structure(
         print("\nNothing to fix. Structure is fine.")
         return
     print("\nFlipping contigs.")
-    for chrom_num in inverted_contigs:
-        for contig in inverted_contigs[chrom_num]:
-            contig_start, contig_end = contig
-            print(
-                f"Structure of chromosome {chrom_num}: "
-                f"flip contig between beads {contig_start} "
-                f"and {contig_end}"
+    # Map (residue number, atom number) to bead position.
+    bead_positions = {
+        bead: position
+        for position, bead in enumerate(
+            zip(
+                coordinates["residue_number"].tolist(),
+                coordinates["atom_number"].tolist(),
             )
-            contig_start_index = coordinates[
-                (coordinates["residue_number"] == chrom_num)
-                & (coordinates["atom_number"] == contig_start)
-            ].index[0]
-            contig_end_index = coordinates[
-                (coordinates["residue_number"] == chrom_num)
-                & (coordinates["atom_number"] == contig_end)
-            ].index[0]
-            contig_before_df = coordinates.loc[: contig_start_index - 1, :]
-            contig_df = coordinates.loc[contig_start_index:contig_end_index, :]
-            contig_after_df = coordinates.loc[contig_end_index + 1 :, :]
-            # Flip contig.
-            contig_df = contig_df[::-1]
-            # Assemble genome structure.
-            coordinates = pd.concat(
-                [contig_before_df, contig_df, contig_after_df]
-            )
-
-    coordinates = coordinates.reset_index(drop=True)
+        )
+    }
+    # Gather boundaries of all inverted contigs of all chromosomes.
+    contigs = [
+        (chrom_num, contig_start, contig_end)
+        for chrom_num, chrom_contigs in inverted_contigs.items()
+        for contig_start, contig_end in chrom_contigs
+    ]
+    print(
+        "\n".join(
+            f"Structure of chromosome {chrom_num}: "
+            f"flip contig between beads {contig_start} "
+            f"and {contig_end}"
+            for chrom_num, contig_start, contig_end in contigs
+        )
+    )
+    contig_start_indexes = [
+        bead_positions[(chrom_num, contig_start)]
+        for chrom_num, contig_start, _ in contigs
+    ]
+    contig_end_indexes = [
+        bead_positions[(chrom_num, contig_end)]
+        for chrom_num, _, contig_end in contigs
+    ]
+    # Flip contigs in a permutation of beads positions
+    # and reorder the structure only once.
+    beads_order = np.arange(len(coordinates))
+    for contig_start_index, contig_end_index in zip(
+        contig_start_indexes, contig_end_indexes
+    ):
+        beads_order[contig_start_index : contig_end_index + 1] = beads_order[
+            contig_start_index : contig_end_index + 1
+        ][::-1]
+
+    coordinates = coordinates.iloc[beads_order].reset_index(drop=True)
     # The 'line_idx' column keeps the real order of atoms in the PDB file.
     coordinates["line_idx"] = coordinates.index
     pdb_structure.df["ATOM"] = coordinates
@@ -320,40 +387,42 @@ def flip_inverted_contigs_in_sequence(
     fasta_name_out : str
         Output FASTA file containing the fixed sequence (at the 3D structure resolution!).
     """
-    # Flip inverted contigs in the genome sequence.
-    genome_fasta = SeqIO.to_dict(SeqIO.parse(fasta_name_in, "fasta"))
-
-    if bool([a for a in inverted_contigs.values() if a == []]):
-        with open(fasta_name_out, "w") as fasta_file:
-            SeqIO.write(genome_fasta.values(), fasta_file, "fasta")
+    # Chromosomes with at least one inverted contig.
+    chromosomes_to_fix = {
+        chromosome_names[chrom_num - 1]: chrom_num
+        for chrom_num, contigs in inverted_contigs.items()
+        if contigs
+    }
+    if not chromosomes_to_fix:
         print("Nothing to fix. Sequence is fine.")
-        return
 
-    for chrom_num in inverted_contigs:
-        chrom_name = chromosome_names[chrom_num - 1]
-        chrom_sequence = str(genome_fasta[chrom_name].seq)
-        for contig in inverted_contigs[chrom_num]:
-            contig_start = contig[0] * HiC_resolution
-            contig_end = contig[1] * HiC_resolution
-            print(
-                f"Sequence of chromosome {chrom_num}: "
-                f"flip inverted contig between base {contig_start} "
-                f"and {contig_end}"
-            )
-            contig_sequence = chrom_sequence[contig_start : contig_end + 1]
-            # Flip contig.
-            contig_sequence = contig_sequence[::-1]
-            # Reassemble chromosome sequence.
-            chrom_sequence = (
-                chrom_sequence[:contig_start]
-                + contig_sequence
-                + chrom_sequence[contig_end + 1 :]
-            )
-        genome_fasta[chrom_name].seq = Seq(chrom_sequence)
-
-    # Write genome sequence.
+    # Index the genome sequence to load only the chromosomes to fix.
+    # Other chromosomes are written unchanged.
+    genome_fasta = SeqIO.index(fasta_name_in, "fasta")
     with open(fasta_name_out, "w") as fasta_file:
-        SeqIO.write(genome_fasta.values(), fasta_file, "fasta")
+        for chrom_name in genome_fasta:
+            if chrom_name not in chromosomes_to_fix:
+                fasta_file.write(genome_fasta.get_raw(chrom_name).decode("ascii"))
+                continue
+            chrom_num = chromosomes_to_fix[chrom_name]
+            chrom_record = genome_fasta[chrom_name]
+            # Mutable copy of the chromosome sequence to flip contigs in place.
+            chrom_sequence = bytearray(str(chrom_record.seq), "ascii")
+            for contig in inverted_contigs[chrom_num]:
+                contig_start = contig[0] * HiC_resolution
+                contig_end = contig[1] * HiC_resolution
+                print(
+                    f"Sequence of chromosome {chrom_num}: "
+                    f"flip inverted contig between base {contig_start} "
+                    f"and {contig_end}"
+                )
+                # Flip contig.
+                chrom_sequence[contig_start : contig_end + 1] = chrom_sequence[
+                    contig_start : contig_end + 1
+                ][::-1]
+            chrom_record.seq = Seq(chrom_sequence.decode("ascii"))
+            SeqIO.write(chrom_record, fasta_file, "fasta")
+    genome_fasta.close()
 
 
 if __name__ == "__main__":
@@ -373,13 +442,29 @@ if __name__ == "__main__":
         ARGS.fasta
     )
 
+    # Read PDB file once for both detection and flipping.
+    PDB_STRUCTURE = PandasPdb().read_pdb(ARGS.pdb)
+
     # Find inverted contigs.
     INVERTED_CONTIGS = find_inverted_contigs(
-        ARGS.pdb, CHROMOSOME_LENGTHS, ARGS.resolution, ARGS.threshold
+        PDB_STRUCTURE,
+        CHROMOSOME_LENGTHS,
+        ARGS.resolution,
+        ARGS.threshold,
+        debug=ARGS.debug,
     )
+    if sum(map(len, INVERTED_CONTIGS.values())) == 0:
+        # Copy input files instead of writing them again.
+        print("\nNothing to fix. Structure and sequence are fine.")
+        print(f"Copying {ARGS.pdb} to {ARGS.output_pdb}.")
+        shutil.copyfile(ARGS.pdb, ARGS.output_pdb)
+        print(f"Copying {ARGS.fasta} to {ARGS.output_fasta}.")
+        shutil.copyfile(ARGS.fasta, ARGS.output_fasta)
+        sys.exit()
+
     # Flip inverted contigs in the genome 3D structure and sequence.
     flip_inverted_contigs_in_structure(
-        INVERTED_CONTIGS, ARGS.pdb, ARGS.output_pdb
+        INVERTED_CONTIGS, PDB_STRUCTURE, ARGS.output_pdb
     )
     flip_inverted_contigs_in_sequence(
         INVERTED_CONTIGS,